@@ -5,24 +5,236 @@
 # See LICENSE file for details
 
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util.retry import Retry
+from urllib3.util.request import ACCEPT_ENCODING
 import os
 import sys
 import time
 import json
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from urllib.parse import urlparse
+import threading
+import queue
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from functools import partial
+import importlib
+from importlib.machinery import EXTENSION_SUFFIXES
+from urllib.parse import ParseResult, urlparse
+from typing import Any, Callable, Deque, Dict, Iterable, Iterator, Optional, Set, Tuple, Union
 import re
 import argparse
 
-def sanitize_filename(filename):
+# HTTP/2クライアント（--http2使用時のみ必要）
+try:
+    import httpx
+except ImportError:
+    httpx = None  # type: ignore
+
+# 展開できる圧縮形式のみを、圧縮率の高いものから順に要求
+# （br/zstdはbrotli/zstandardがインストールされている場合のみ有効）
+_ENCODING_PREFERENCE = ['zstd', 'br', 'gzip', 'deflate']
+_SUPPORTED_ENCODINGS = set(ACCEPT_ENCODING.split(','))
+
+# デフォルトのHTTPヘッダー
+DEFAULT_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36',
+    'Accept-Encoding': ', '.join(e for e in _ENCODING_PREFERENCE if e in _SUPPORTED_ENCODINGS),
+}
+
+# ストリーミング時のチャンクサイズ
+CHUNK_SIZE = 65536
+
+# ファイル名として使用できない文字の変換テーブル（Windowsで使用できない文字）
+SANITIZE_TABLE = str.maketrans({c: '_' for c in '<>:"|?*'})
+
+# クエリ文字列のサニタイズ用
+QUERY_UNSAFE_RE = re.compile(r'[^a-zA-Z0-9]')
+
+# 複数ヘッダーの区切り文字（セミコロンまたはカンマ）
+HEADER_SEPARATOR_RE = re.compile(r'[;,]')
+
+# 一時ファイルを開く際のフラグ（既存ファイルがあればFileExistsError）
+OPEN_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+
+# ダウンロード結果（成功したか, URL, 書き込んだバイト数（スキップした場合はNone））
+DownloadResult = Tuple[bool, str, Optional[int]]
+
+# ダウンロード対象（URL, パース結果（パースできない場合はNone））
+Target = Tuple[str, Optional[ParseResult]]
+
+# 作成済みディレクトリのキャッシュ（同じディレクトリへのmakedirsを省略）
+_created_dirs: Set[str] = set()
+_created_dirs_lock = threading.Lock()
+
+# ホストごとの同時ダウンロード数（0は無制限）と、上限に達したホストのURLを保留しておく最大数
+DEFAULT_PER_HOST = 0
+MAX_DEFERRED_TARGETS = 10000
+
+# 接続ウォームアップの並列数
+PREWARM_WORKERS = 32
+
+# 出力メッセージのキューと、それを一括で標準出力へ書き出すスレッド
+PRINT_INTERVAL = 0.1
+_log_queue: "queue.Queue[Tuple[str, Optional[str]]]" = queue.Queue()
+_printer_thread: Optional[threading.Thread] = None
+
+# 失敗URLファイルへの書き込みに失敗した場合のエラー
+_failed_file_error: Optional[OSError] = None
+
+# タイムアウト・通信エラーとして扱う例外（HTTP/2クライアントの例外を含む）
+TIMEOUT_ERRORS = (requests.exceptions.Timeout,) + ((httpx.TimeoutException,) if httpx else ())
+REQUEST_ERRORS = (requests.exceptions.RequestException, urllib3.exceptions.HTTPError) + ((httpx.HTTPError,) if httpx else ())
+
+# ワーカースレッドごとのSession（Keep-Aliveで接続を再利用）
+_thread_local = threading.local()
+
+def get_session(custom_headers: Optional[Dict[str, str]] = None, pool_size: int = 10) -> requests.Session:
+    """スレッドごとのrequests.Sessionを取得（初回呼び出し時に作成）"""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                              max_retries=Retry(total=2, backoff_factor=0.3))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        
+        # ヘッダーはSession作成時に一度だけ構築
+        session.headers.update(DEFAULT_HEADERS)
+        if custom_headers:
+            session.headers.update(custom_headers)
+        _thread_local.session = session
+    return session
+
+def create_http2_client(custom_headers: Optional[Dict[str, str]] = None, pool_size: int = 10) -> Any:
+    """全スレッドで共有するHTTP/2対応クライアントを作成（1接続で複数リクエストを多重化）"""
+    headers = dict(DEFAULT_HEADERS)
+    if custom_headers:
+        headers.update(custom_headers)
+    
+    transport = httpx.HTTPTransport(
+        http2=True, verify=False, retries=2,
+        limits=httpx.Limits(max_keepalive_connections=pool_size, max_connections=pool_size * 2))
+    return httpx.Client(transport=transport, headers=headers, timeout=30.0, follow_redirects=True)
+
+def write_all(fd: int, data: Union[bytes, memoryview]) -> None:
+    """部分書き込みを考慮してデータをすべて書き込む"""
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+def log(message: str) -> None:
+    """メッセージを出力（出力スレッドが動いていればキュー経由）"""
+    if _printer_thread is None:
+        print(message)
+    else:
+        _log_queue.put(('message', message))
+
+def log_progress(message: str) -> None:
+    """進捗行を更新（同じ周期内の更新は最後の1つだけ表示）"""
+    _log_queue.put(('progress', message))
+
+def log_failure(url: str) -> None:
+    """失敗したURLを記録（出力スレッドが失敗URLファイルへ随時追記）"""
+    _log_queue.put(('failed', url))
+
+def _print_loop(failed_path: str) -> None:
+    """キューに溜まったメッセージを一定間隔でまとめて書き出す"""
+    global _failed_file_error
+    progress = None
+    running = True
+    failed_file = None
+    
+    while running:
+        # 最初のメッセージが来るまで待ち、そこから周期の終わりまでに届いた分をまとめて1回で書き出す
+        # （終了指示が来た場合は周期を待たずに書き出す）
+        items = [_log_queue.get()]
+        deadline = time.monotonic() + PRINT_INTERVAL
+        while items[-1][0] != 'stop':
+            remaining = deadline - time.monotonic()
+            try:
+                items.append(_log_queue.get(timeout=remaining) if remaining > 0 else _log_queue.get_nowait())
+            except queue.Empty:
+                break
+        
+        lines = []
+        failed_lines = []
+        progress_changed = False
+        for kind, message in items:
+            if kind == 'stop':
+                running = False
+            elif kind == 'progress':
+                progress = message
+                progress_changed = True
+            elif kind == 'failed':
+                failed_lines.append(f"{message}\n")
+            else:
+                lines.append(f"{message}\n")
+        
+        # 中断されても失敗URLが失われないよう、周期ごとにファイルへ書き出す
+        # （書き込めない場合も出力スレッドは止めず、以降の書き込みを諦めて警告する）
+        if failed_lines and _failed_file_error is None:
+            try:
+                if failed_file is None:
+                    failed_file = open(failed_path, 'w')
+                failed_file.write(''.join(failed_lines))
+                failed_file.flush()
+            except OSError as e:
+                _failed_file_error = e
+                lines.append(f"Warning: Could not write failed URLs to '{failed_path}': {e}\n")
+        
+        if progress is not None and (lines or progress_changed):
+            lines.append(f"{progress}\r")
+        if lines:
+            sys.stdout.write(''.join(lines))
+            sys.stdout.flush()
+    
+    if failed_file is not None:
+        try:
+            failed_file.close()
+        except OSError:
+            pass
+
+def start_printer(failed_path: str = 'failed_urls.txt') -> None:
+    """出力スレッドを開始（失敗したURLはfailed_pathへ書き出す）"""
+    global _printer_thread
+    _printer_thread = threading.Thread(target=_print_loop, args=(failed_path,), daemon=True)
+    _printer_thread.start()
+
+def stop_printer() -> None:
+    """残りのメッセージを書き出して出力スレッドを停止"""
+    global _printer_thread
+    if _printer_thread is None:
+        return
+    _log_queue.put(('stop', None))
+    _printer_thread.join()
+    _printer_thread = None
+
+def ensure_directory(dir_path: str) -> None:
+    """ディレクトリを作成（作成済みの場合はシステムコールを発行しない）"""
+    if dir_path in _created_dirs:
+        return
+    
+    # 作成が完了してからキャッシュに登録（他スレッドが作成前に書き込まないように）
+    os.makedirs(dir_path, exist_ok=True)
+    with _created_dirs_lock:
+        _created_dirs.add(dir_path)
+
+def drop_page_cache(fd: int) -> None:
+    """書き込んだページをページキャッシュに残さないようカーネルに通知（対応OSのみ）"""
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        except OSError:
+            pass
+
+def sanitize_filename(filename: str) -> str:
     """ファイル名として使用できない文字を置換"""
     # Windowsで使用できない文字を置換
-    return re.sub(r'[<>:"|?*]', '_', filename)
+    return filename.translate(SANITIZE_TABLE)
 
-def create_directory_structure(url, base_dir):
-    """URLから階層構造を維持したディレクトリパスを生成"""
-    parsed_url = urlparse(url)
-    
+def create_directory_structure(parsed_url: ParseResult, base_dir: str) -> Tuple[str, str]:
+    """パース済みのURLから階層構造を維持したディレクトリパスを生成"""
     # ドメイン名をディレクトリとして使用
     domain = parsed_url.netloc
     
@@ -52,81 +264,249 @@ def create_directory_structure(url, base_dir):
     
     # クエリパラメータがある場合、ファイル名に追加
     if parsed_url.query:
-        query_safe = re.sub(r'[^a-zA-Z0-9]', '_', parsed_url.query)[:50]  # 長すぎる場合は切り詰め
+        query_safe = QUERY_UNSAFE_RE.sub('_', parsed_url.query)[:50]  # 長すぎる場合は切り詰め
         base_name, ext = os.path.splitext(file_name)
         file_name = f"{base_name}_{query_safe}{ext}"
     
     return dir_path, file_name
 
-def download_js(url, output_dir="./js_files", custom_headers=None):
-    """JavaScriptファイルを階層構造を維持してダウンロード"""
+def save_chunks(chunks: Iterable[bytes], path: str, drop_cache: bool = False) -> int:
+    """チャンクを新規ファイルへ書き込み、書き込んだバイト数を返す（失敗時はファイルを削除）"""
+    # open()のバッファ層を通さず、ファイルディスクリプタへ直接書き込む
     try:
+        fd = os.open(path, OPEN_FLAGS, 0o666)
+    except FileExistsError:
+        # 前回中断時の一時ファイルが残っている場合は作り直す
+        os.remove(path)
+        fd = os.open(path, OPEN_FLAGS, 0o666)
+    try:
+        try:
+            bytes_written = 0
+            for chunk in chunks:
+                write_all(fd, chunk)
+                bytes_written += len(chunk)
+            
+            # fsyncはせず、ページキャッシュの解放だけを依頼する
+            if drop_cache:
+                drop_page_cache(fd)
+        finally:
+            os.close(fd)
+    except Exception:
+        os.remove(path)
+        raise
+    return bytes_written
+
+def stream_to_file(session: requests.Session, url: str, path: str, drop_cache: bool = False) -> int:
+    """レスポンスをメモリに溜めずにファイルへ書き込み、書き込んだバイト数を返す"""
+    with session.get(url, timeout=30, stream=True, verify=False) as response:
+        response.raise_for_status()
+        return save_chunks(response.iter_content(chunk_size=CHUNK_SIZE), path, drop_cache)
+
+def stream_to_file_http2(client: Any, url: str, path: str, drop_cache: bool = False) -> int:
+    """HTTP/2クライアントでレスポンスをファイルへ書き込み、書き込んだバイト数を返す"""
+    with client.stream('GET', url) as response:
+        response.raise_for_status()
+        return save_chunks(response.iter_bytes(CHUNK_SIZE), path, drop_cache)
+
+def download_js(url: str, parsed_url: Optional[ParseResult], output_dir: str = "./js_files",
+                custom_headers: Optional[Dict[str, str]] = None, pool_size: int = 10, http2_client: Any = None,
+                drop_cache: bool = False) -> DownloadResult:
+    """JavaScriptファイルを階層構造を維持してダウンロード（スキップした場合のバイト数はNone）"""
+    try:
+        # パース済みでない場合はここでパース（不正なURLはエラーとして扱う）
+        if parsed_url is None:
+            parsed_url = urlparse(url)
+        
         # ディレクトリとファイル名を生成
-        dir_path, filename = create_directory_structure(url, output_dir)
+        dir_path, filename = create_directory_structure(parsed_url, output_dir)
         
         # ディレクトリが存在しない場合は作成
-        os.makedirs(dir_path, exist_ok=True)
+        ensure_directory(dir_path)
         
         # 完全なファイルパス
         filepath = os.path.join(dir_path, filename)
         
-        # 既にファイルが存在する場合、スキップするか確認
+        # 既にファイルが存在する場合はリクエストを送らずにスキップ
         if os.path.exists(filepath):
-            print(f"[SKIP] Already exists: {filepath}")
-            return True, url
-        
-        # HTTPヘッダーを構築
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        }
+            log(f"[SKIP] Already exists: {filepath}")
+            return True, url, None
         
-        # カスタムヘッダーを追加
-        if custom_headers:
-            headers.update(custom_headers)
+        # 一時ファイル（.part）へ書き込み、完了してから本来のパスへ配置する
+        # （中断されても不完全なファイルが次回スキップされないように）
+        part_path = f"{filepath}.part"
         
-        # HTTPリクエストを送信
-        response = requests.get(url, headers=headers, timeout=30, verify=False)
-        response.raise_for_status()
+        # HTTPリクエストを送信（共有HTTP/2クライアント、またはスレッドごとのSessionで接続を再利用）
+        if http2_client:
+            bytes_written = stream_to_file_http2(http2_client, url, part_path, drop_cache)
+        else:
+            session = get_session(custom_headers, pool_size)
+            bytes_written = stream_to_file(session, url, part_path, drop_cache)
         
-        # ファイルを保存
-        with open(filepath, 'w', encoding='utf-8') as f:
-            f.write(response.text)
+        # 書き込みが完了したファイルを本来のパスへ配置
+        os.replace(part_path, filepath)
         
         # 相対パスで表示（見やすくするため）
         relative_path = os.path.relpath(filepath, output_dir)
-        print(f"[SUCCESS] {url} -> {relative_path}")
-        return True, url
+        log(f"[SUCCESS] {url} -> {relative_path}")
+        return True, url, bytes_written
         
-    except requests.exceptions.Timeout:
-        print(f"[TIMEOUT] {url}")
-        return False, url
-    except requests.exceptions.RequestException as e:
-        print(f"[ERROR] {url}: {str(e)}")
-        return False, url
+    except TIMEOUT_ERRORS:
+        log(f"[TIMEOUT] {url}")
+        return False, url, 0
+    except REQUEST_ERRORS as e:
+        # httpxのエラーメッセージは複数行になるため、1URL1行に収まるよう先頭行のみ表示
+        message = str(e).partition('\n')[0]
+        log(f"[ERROR] {url}: {message}")
+        return False, url, 0
     except Exception as e:
-        print(f"[ERROR] {url}: Unexpected error: {str(e)}")
-        return False, url
+        log(f"[ERROR] {url}: Unexpected error: {str(e)}")
+        return False, url, 0
+
+def iter_targets(urls: Iterable[str]) -> Iterator[Target]:
+    """URLを1つずつパースして(URL, パース結果)を返す（パースできない場合はNone）"""
+    for url in urls:
+        try:
+            yield url, urlparse(url)
+        except ValueError:
+            # ダウンロード時に改めてパースし、失敗として扱われる
+            yield url, None
+
+class HostScheduler:
+    """ホストごとの同時ダウンロード数を超えないよう、次に投入する(URL, パース結果)を選ぶ"""
+    
+    def __init__(self, targets: Iterable[Target], per_host: int, max_deferred: int = MAX_DEFERRED_TARGETS) -> None:
+        self.per_host = per_host
+        self.max_deferred = max_deferred
+        self._targets = iter(targets)
+        self._active: Dict[str, int] = {}
+        self._deferred: Dict[str, Deque[Target]] = {}
+        self._deferred_count = 0
+    
+    def host_of(self, target: Target) -> Optional[str]:
+        """制限の対象となるホストを返す（制限なし、またはパースできないURLはNone）"""
+        parsed_url = target[1]
+        if not self.per_host or parsed_url is None:
+            return None
+        return parsed_url.netloc
+    
+    def _has_room(self, host: str) -> bool:
+        return self._active.get(host, 0) < self.per_host
+    
+    def _start(self, host: Optional[str]) -> None:
+        if host is not None:
+            self._active[host] = self._active.get(host, 0) + 1
+    
+    def next_target(self) -> Optional[Target]:
+        """今すぐ投入できるターゲットを返す（なければNone）"""
+        # 空きができたホストの保留分を優先
+        for host, deferred in self._deferred.items():
+            if self._has_room(host):
+                target = deferred.popleft()
+                if not deferred:
+                    del self._deferred[host]
+                self._deferred_count -= 1
+                self._start(host)
+                return target
+        
+        # 上限に達しているホストのURLは保留し、他のホストのURLを先に投入する
+        while self._deferred_count < self.max_deferred:
+            next_item = next(self._targets, None)
+            if next_item is None:
+                return None
+            next_host = self.host_of(next_item)
+            if next_host is None or self._has_room(next_host):
+                self._start(next_host)
+                return next_item
+            self._deferred.setdefault(next_host, deque()).append(next_item)
+            self._deferred_count += 1
+        return None
+    
+    def finish(self, host: Optional[str]) -> None:
+        """ダウンロードの完了を記録"""
+        if host is not None:
+            self._active[host] -= 1
+
+def iter_downloads(targets: Iterable[Target], threads: int,
+                   download: Callable[[str, Optional[ParseResult]], DownloadResult],
+                   per_host: int = DEFAULT_PER_HOST) -> Iterator[DownloadResult]:
+    """(URL, パース結果)を少しずつ投入しながらdownloadで並列ダウンロードし、完了した順に結果を返す"""
+    scheduler = HostScheduler(targets, per_host)
+    
+    # 未完了タスクはスレッド数の2倍までに抑える（大量URLでもFutureを溜め込まない）
+    max_pending = threads * 2
+    
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending: Dict[Future, Optional[str]] = {}
+        while True:
+            # 投入できるURLを上限まで投入
+            while len(pending) < max_pending:
+                target = scheduler.next_target()
+                if target is None:
+                    break
+                pending[executor.submit(download, *target)] = scheduler.host_of(target)
+            
+            if not pending:
+                break
+            
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                scheduler.finish(pending.pop(future))
+                yield future.result()
+
+def print_tree(dir_path: str, level: int = 0) -> None:
+    """ディレクトリ構造を表示（ファイルは最初の5階層まで）"""
+    indent = ' ' * 2 * (level + 1)
+    subdirs = []
+    
+    # scandirのDirEntryはstat結果をキャッシュするため、os.walkより高速
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry)
+            elif entry.name.endswith('.js') and level < 5:
+                print(f"{indent}{entry.name} ({entry.stat().st_size:,} bytes)")
+    
+    for entry in subdirs:
+        print(f"{indent}{entry.name}/")
+        print_tree(entry.path, level + 1)
 
-def parse_headers(header_str):
+def warm_up_host(http2_client: Any, parsed_url: ParseResult) -> bool:
+    """共有HTTP/2クライアントでホストへの接続を確立しておき、成功したかを返す"""
+    try:
+        http2_client.head(f"{parsed_url.scheme}://{parsed_url.netloc}/")
+        return True
+    except REQUEST_ERRORS:
+        # 失敗してもダウンロード時に改めてエラーとして扱われる
+        return False
+
+def warm_up_hosts(http2_client: Any, targets: Iterable[Target]) -> Tuple[int, int]:
+    """ダウンロード開始前に全ホストへの接続確立を並列に済ませ、(成功したホスト数, ホスト数)を返す"""
+    # ホスト（scheme + netloc）ごとに代表のURLを1つ選ぶ
+    hosts = {(p.scheme, p.netloc): p for _, p in targets if p is not None and p.hostname}
+    with ThreadPoolExecutor(max_workers=PREWARM_WORKERS) as executor:
+        warmed = sum(executor.map(partial(warm_up_host, http2_client), hosts.values()))
+    return warmed, len(hosts)
+
+def parse_headers(header_str: Optional[str]) -> Dict[str, str]:
     """ヘッダー文字列をパース"""
-    headers = {}
+    headers: Dict[str, str] = {}
     if not header_str:
         return headers
     
     # 複数のヘッダーをセミコロンまたはカンマで区切る
-    header_pairs = re.split(r'[;,]', header_str)
+    header_pairs = HEADER_SEPARATOR_RE.split(header_str)
     
     for pair in header_pairs:
         pair = pair.strip()
-        if ':' in pair:
-            key, value = pair.split(':', 1)
+        key, sep, value = pair.partition(':')
+        if sep:
             headers[key.strip()] = value.strip()
     
     return headers
 
-def load_headers_from_file(filename):
+def load_headers_from_file(filename: str) -> Dict[str, str]:
     """ファイルからヘッダーを読み込む"""
-    headers = {}
+    headers: Dict[str, str] = {}
     try:
         with open(filename, 'r') as f:
             # JSON形式の場合
@@ -136,16 +516,15 @@ def load_headers_from_file(filename):
                 # Key: Value 形式の場合
                 f.seek(0)
                 for line in f:
-                    line = line.strip()
-                    if line and ':' in line:
-                        key, value = line.split(':', 1)
+                    key, sep, value = line.partition(':')
+                    if sep:
                         headers[key.strip()] = value.strip()
     except FileNotFoundError:
         print(f"Warning: Header file '{filename}' not found")
     
     return headers
 
-def main():
+def main() -> None:
     parser = argparse.ArgumentParser(
         description='Download JavaScript files while maintaining directory structure',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -166,6 +545,9 @@ Examples:
   # Headers from file (Key: Value format)
   python js_downloader.py urls.txt --header-file headers.txt
 
+  # Multiplex requests over HTTP/2 (requires: pip install 'httpx[http2]')
+  python js_downloader.py urls.txt --http2
+
 Header file formats:
   JSON format (headers.json):
     {
@@ -186,18 +568,38 @@ Header file formats:
                         help='Add custom header (format: "Key: Value"). Can be used multiple times.')
     parser.add_argument('--header-file', help='Load headers from file (JSON or Key:Value format)')
     parser.add_argument('-t', '--threads', type=int, default=10, help='Number of concurrent downloads (default: 10)')
+    parser.add_argument('--per-host', type=int, default=DEFAULT_PER_HOST,
+                        help='Maximum concurrent downloads per host, 0 for no limit (default: 0, ignored with --http2)')
+    parser.add_argument('--http2', action='store_true',
+                        help='Use a shared HTTP/2 client (requires httpx[http2])')
+    parser.add_argument('--prewarm', action='store_true',
+                        help='Open HTTP/2 connections to all hosts concurrently before downloading (--http2 only)')
+    parser.add_argument('--drop-cache', action='store_true',
+                        help='Ask the kernel to drop written files from the page cache (posix_fadvise)')
+    parser.add_argument('--print-tree', action='store_true',
+                        help='Print the output directory structure after downloading')
     parser.add_argument('-v', '--verbose', action='store_true', help='Verbose output (show headers being used)')
     
     args = parser.parse_args()
     
+    if args.http2:
+        try:
+            import h2  # noqa: F401
+            http2_available = httpx is not None
+        except ImportError:
+            http2_available = False
+        if not http2_available:
+            print("Error: --http2 requires httpx with HTTP/2 support (pip install 'httpx[http2]')")
+            sys.exit(1)
+    
     # ヘッダーを収集
-    custom_headers = {}
+    custom_headers: Dict[str, str] = {}
     
     # コマンドラインからのヘッダー
     if args.headers:
         for header in args.headers:
-            if ':' in header:
-                key, value = header.split(':', 1)
+            key, sep, value = header.partition(':')
+            if sep:
                 custom_headers[key.strip()] = value.strip()
     
     # ファイルからのヘッダー
@@ -219,85 +621,130 @@ Header file formats:
     
     # URLリストを読み込む
     try:
+        # 1行ずつ読みながら重複を除去（dictなので出現順は保持される）
+        url_count = 0
+        unique_urls: Dict[str, None] = {}
         with open(args.url_file, 'r') as f:
-            urls = [line.strip() for line in f if line.strip()]
+            for line in f:
+                url = line.strip()
+                if url:
+                    url_count += 1
+                    unique_urls[url] = None
+        urls = unique_urls.keys()
     except FileNotFoundError:
         print(f"Error: File '{args.url_file}' not found")
         sys.exit(1)
     
     output_dir = args.output_dir
     
-    print(f"Found {len(urls)} JavaScript URLs to download")
+    # HTTP/2では1接続に多重化されるため、ホストごとの制限は行わない
+    per_host = 0 if args.http2 else args.per_host
+    
+    print(f"Found {url_count} JavaScript URLs to download")
     print(f"Output directory: {output_dir}")
     print(f"Concurrent downloads: {args.threads}")
+    if per_host:
+        print(f"Concurrent downloads per host: {per_host}")
+    if args.http2:
+        print("Using HTTP/2 multiplexing")
     if custom_headers:
         print(f"Using {len(custom_headers)} custom header(s)")
     print(f"Maintaining directory structure based on URL paths\n")
     
-    # 重複URLを削除
-    unique_urls = list(set(urls))
-    if len(unique_urls) < len(urls):
-        print(f"Removed {len(urls) - len(unique_urls)} duplicate URLs")
-        urls = unique_urls
+    # 重複URLの件数を表示
+    if len(urls) < url_count:
+        print(f"Removed {url_count - len(urls)} duplicate URLs")
+    
+    # URLは投入時に一度だけパースし、以降はパース結果を使い回す
+    # （事前接続ではダウンロード前に全ホストが必要なため、パース結果をリストにして共有する）
+    targets: Iterable[Target] = iter_targets(urls)
+    if args.prewarm and args.http2:
+        targets = list(targets)
     
     # 並列ダウンロード
     successful = 0
     failed = 0
-    failed_urls = []
+    downloaded = 0
+    skipped = 0
+    total_size = 0
     
-    with ThreadPoolExecutor(max_workers=args.threads) as executor:
-        futures = {executor.submit(download_js, url, output_dir, custom_headers): url for url in urls}
-        
-        for future in as_completed(futures):
-            success, url = future.result()
+    # HTTP/2使用時は全スレッドで1つのクライアントを共有する
+    http2_client = create_http2_client(custom_headers, args.threads) if args.http2 else None
+    
+    # 初回リクエストの名前解決・接続確立の待ち時間を事前に並列で済ませる
+    # （スレッドごとのSessionには共有する接続プールがないため、HTTP/2使用時のみ）
+    if args.prewarm and http2_client:
+        warmed, host_count = warm_up_hosts(http2_client, targets)
+        print(f"Opened connections to {warmed}/{host_count} host(s)")
+    elif args.prewarm:
+        print("Note: --prewarm only has an effect with --http2; ignored")
+    
+    # URL以外のダウンロード設定はキーワード引数で固定しておく
+    download = partial(download_js, output_dir=output_dir, custom_headers=custom_headers,
+                       pool_size=args.threads, http2_client=http2_client,
+                       drop_cache=args.drop_cache)
+    
+    # ワーカーからの出力は専用スレッドがまとめて書き出す
+    start_printer()
+    try:
+        for success, url, bytes_written in iter_downloads(targets, args.threads, download, per_host):
             if success:
                 successful += 1
+                if bytes_written is None:
+                    skipped += 1
+                else:
+                    downloaded += 1
+                    total_size += bytes_written
             else:
                 failed += 1
-                failed_urls.append(url)
+                log_failure(url)
             
             # 進捗表示
             total = successful + failed
-            print(f"Progress: {total}/{len(urls)} (Success: {successful}, Failed: {failed})", end='\r')
+            log_progress(f"Progress: {total}/{len(urls)} (Success: {successful}, Failed: {failed})")
+    finally:
+        stop_printer()
+        if http2_client:
+            http2_client.close()
     
     print(f"\n\nDownload completed: {successful} success, {failed} failed")
     
-    # 失敗したURLをファイルに保存
-    if failed_urls:
-        with open('failed_urls.txt', 'w') as f:
-            for url in failed_urls:
-                f.write(f"{url}\n")
+    # 失敗したURLはダウンロード中に随時保存済み
+    if failed and _failed_file_error is None:
         print("Failed URLs saved to failed_urls.txt")
     
-    # ダウンロードしたファイルの統計情報を表示
-    print("\nDirectory structure created:")
-    total_size = 0
-    file_count = 0
-    
-    for root, dirs, files in os.walk(output_dir):
-        level = root.replace(output_dir, '').count(os.sep)
-        indent = ' ' * 2 * level
-        relative_root = os.path.relpath(root, output_dir)
-        if relative_root != '.':
-            print(f"{indent}{os.path.basename(root)}/")
+    # ディレクトリ構造を表示
+    if args.print_tree and os.path.isdir(output_dir):
+        print("\nDirectory structure created:")
+        print_tree(output_dir)
+    
+    # ダウンロード中に集計した統計情報を表示
+    print(f"\nTotal: {downloaded} files, {total_size:,} bytes downloaded ({total_size/1024/1024:.2f} MB)")
+    if skipped:
+        print(f"Skipped: {skipped} files (already exist)")
+
+def load_main() -> Any:
+    """mypycでコンパイル済みのモジュールがあればそのmainを、なければこのファイルのmainを返す"""
+    script_path = os.path.abspath(__file__)
+    script_dir = os.path.dirname(script_path)
+    for suffix in EXTENSION_SUFFIXES:
+        compiled_path = os.path.join(script_dir, f"js_download{suffix}")
+        if not os.path.exists(compiled_path):
+            continue
         
-        # ファイルサイズの合計を計算
-        subindent = ' ' * 2 * (level + 1)
-        for file in files:
-            if file.endswith('.js'):
-                file_path = os.path.join(root, file)
-                file_size = os.path.getsize(file_path)
-                total_size += file_size
-                file_count += 1
-                # 最初の5階層まで表示
-                if level < 5:
-                    print(f"{subindent}{file} ({file_size:,} bytes)")
-    
-    print(f"\nTotal: {file_count} files, {total_size:,} bytes ({total_size/1024/1024:.2f} MB)")
+        # ソースより古いコンパイル済みモジュールは使わない（編集内容が反映されないため）
+        if os.path.getmtime(compiled_path) < os.path.getmtime(script_path):
+            print(f"Warning: {os.path.basename(compiled_path)} is older than js_download.py and was ignored "
+                  "(rebuild it with mypyc)")
+            break
+        try:
+            return importlib.import_module('js_download').main
+        except ImportError:
+            break
+    return main
 
 if __name__ == "__main__":
     # SSL証明書の警告を無効化（開発環境用）
-    import urllib3
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     
-    main()
+    load_main()()